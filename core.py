@@ -1,16 +1,24 @@
-from os import path
+import atexit
+from concurrent.futures import ThreadPoolExecutor
+import weakref
+from os import path, stat
 from sys import exit
+from queue import SimpleQueue
 from threading import current_thread
-from logging import basicConfig, getLogger, StreamHandler, Formatter, INFO, ERROR
-from sqlalchemy import create_engine
-import sqlalchemy.ext.declarative as sed
+from time import sleep
+from logging import getLogger, StreamHandler, Formatter, INFO, ERROR
+from logging import Formatter as PlainFormatter
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
 from telegram.utils.request import Request
-from telegram import ReplyKeyboardRemove, CallbackQuery, PreCheckoutQuery, error
+from telegram import Chat, ReplyKeyboardRemove, error
 
-from database import TableDeclarativeBase
+from database import Session, TableDeclarativeBase
 from duckbot import factory
 from localization import Localization
 from nuconfig import NuConfig
+from utils import submit_logged
 from worker import Worker, CancelSignal
 
 try:
@@ -19,9 +27,28 @@ except ImportError:
     pass  # Use the default Formatter imported from logging
 
 
+# The only update types dispatched by the main loop; Telegram won't send the others
+ALLOWED_UPDATES = ["message", "callback_query", "pre_checkout_query"]
+# The maximum number of updates returned by a single getUpdates call
+UPDATES_BATCH_SIZE = 100
+
+# Threads sending the replies of the main loop, so that polling never waits for them
+_outbound = ThreadPoolExecutor(max_workers=4, thread_name_prefix="tg-out")
+
+
+def _config_stamp(*file_paths):
+    """Identify the current version of the given files by their modification time and size."""
+    stamp = []
+    for file_path in file_paths:
+        file_stat = stat(file_path)
+        stamp.append(f"{file_path}:{file_stat.st_mtime_ns}:{file_stat.st_size}")
+    return "\n".join(stamp)
+
+
 def load_config():
     config_file_path = "config/config.toml"
     template_config_path = "config/template_config.toml"
+    validated_stamp_path = "config/.validated"
 
     if not path.isfile(template_config_path):
         raise FileNotFoundError(f"{template_config_path} does not exist!")
@@ -35,6 +62,18 @@ def load_config():
             f"{config_file_path} has been created from template. Customize it, then restart the bot."
         )
 
+    # If neither file changed since the last successful validation, skip it
+    stamp = _config_stamp(template_config_path, config_file_path)
+    try:
+        with open(validated_stamp_path, encoding="utf8") as validated:
+            already_validated = validated.read() == stamp
+    except OSError:
+        already_validated = False
+
+    if already_validated:
+        with open(config_file_path, encoding="utf8") as config:
+            return NuConfig(config)
+
     with open(template_config_path, encoding="utf8") as template, open(
         config_file_path, encoding="utf8"
     ) as config:
@@ -44,30 +83,60 @@ def load_config():
                 "Errors found in config file. Please fix them and restart the bot."
             )
 
+    # Remember that this version of the config files is valid
+    try:
+        with open(validated_stamp_path, "w", encoding="utf8") as validated:
+            validated.write(stamp)
+    except OSError:
+        pass  # Validation will simply run again on the next start
+
     return user_cfg
 
 
 def setup_logging(log_level, log_format):
-    basicConfig(
-        filename="log.log",
-        filemode="a",
-        format=log_format,
-        level=log_level,
-        style="{",
+    # Log calls only enqueue records, the listener thread writes them to the console and the log file
+    log_queue = SimpleQueue()
+    stream_handler = StreamHandler()
+    stream_handler.setFormatter(Formatter(log_format, style="{"))
+    file_handler = RotatingFileHandler(
+        "log.log", maxBytes=10 * 1024 * 1024, backupCount=3, encoding="utf8"
     )
+    file_handler.setFormatter(PlainFormatter(log_format, style="{"))
+    listener = QueueListener(log_queue, stream_handler, file_handler)
+    listener.start()
+    # Flush the pending records when the bot exits
+    atexit.register(listener.stop)
     root_log = getLogger()
     root_log.setLevel(log_level)
-    stream_handler = StreamHandler()
-    stream_handler.setFormatter(Formatter(log_format, style="{"))
     root_log.handlers.clear()
-    root_log.addHandler(stream_handler)
+    root_log.addHandler(QueueHandler(log_queue))
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Use the write-ahead log, so that commits don't wait for a full disk sync."""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.close()
 
 
 def setup_database(db_engine):
-    engine = create_engine(db_engine)
-    TableDeclarativeBase.metadata.bind = engine
-    TableDeclarativeBase.metadata.create_all()
-    sed.DeferredReflection.prepare(engine)
+    is_sqlite = make_url(db_engine).get_backend_name() == "sqlite"
+    # SQLite connections can't be shared between threads, so leave its pool as it is
+    if is_sqlite:
+        pool_args = {}
+    else:
+        pool_args = {"pool_size": 10, "max_overflow": 20}
+    # Check pooled connections before use and renew them hourly, so the first query after a long idle doesn't stall
+    engine = create_engine(
+        db_engine, future=True, pool_pre_ping=True, pool_recycle=3600, **pool_args
+    )
+    if is_sqlite:
+        event.listen(engine, "connect", _set_sqlite_pragmas)
+    TableDeclarativeBase.metadata.create_all(engine)
+    Session.configure(bind=engine)
     return engine
 
 
@@ -79,193 +148,260 @@ def initialize_bot(user_cfg):
     return bot, me
 
 
+class _DefaultStrings(dict):
+    """The default language strings sent by the main loop, resolved lazily and then kept."""
+
+    def __init__(self, loc):
+        super().__init__()
+        self.loc = loc
+
+    def __missing__(self, key):
+        string = self[key] = self.loc.get(key)
+        return string
+
+
+def _safe_outbound(log, func, *args, **kwargs):
+    """Run a Bot API call in the outbound pool."""
+    # DuckBot already handles the Telegram errors, anything else would silently die with the future
+    return submit_logged(_outbound, log, func, *args, **kwargs)
+
+
+def _answer_expired_pre_checkout(log, bot, pre_checkout_query_id, error_message):
+    """Refuse a pre-checkout query for an invoice that has expired."""
+    try:
+        bot.answer_pre_checkout_query(
+            pre_checkout_query_id, ok=False, error_message=error_message
+        )
+    except error.BadRequest:
+        log.error("pre-checkout query expired before an answer could be sent!")
+
+
+def _handle_message(log, bot, chat_workers, default_strings, user_cfg, update):
+    """Handle an update containing a message."""
+    # Ensure the message has been sent in a private chat
+    if update.message.chat.type != Chat.PRIVATE:
+        log.debug(
+            "Received a message from a non-private chat: %s", update.message.chat.id
+        )
+        # Notify the chat
+        _safe_outbound(
+            log,
+            bot.send_message,
+            update.message.chat.id,
+            default_strings["error_nonprivate_chat"],
+        )
+        # Skip the update
+        return
+    # If the message is a start command...
+    if update.message.text and update.message.text.startswith("/start"):
+        log.info("Received /start from: %s", update.message.chat.id)
+        # Check if a worker already exists for that chat
+        old_worker = chat_workers.get(update.message.chat.id)
+        # If it exists and is still running, gracefully stop the worker
+        if old_worker is not None and old_worker.is_alive():
+            log.debug("Received request to stop %s", old_worker.name)
+            old_worker.stop("request")
+        # Initialize a new worker for the chat
+        new_worker = Worker(
+            bot=bot,
+            chat=update.message.chat,
+            telegram_user=update.message.from_user,
+            cfg=user_cfg,
+            daemon=True,
+        )
+        # Start the worker
+        log.debug("Starting %s", new_worker.name)
+        new_worker.start()
+        # Store the worker in the dictionary
+        chat_workers[update.message.chat.id] = new_worker
+        # Skip the update
+        return
+    # Otherwise, forward the update to the corresponding worker
+    receiving_worker = chat_workers.get(update.message.chat.id)
+    # Ensure a worker exists for the chat and is alive
+    if receiving_worker is None:
+        log.debug(
+            "Received a message in a chat without worker: %s", update.message.chat.id
+        )
+        # Suggest that the user restarts the chat with /start
+        _safe_outbound(
+            log,
+            bot.send_message,
+            update.message.chat.id,
+            default_strings["error_no_worker_for_chat"],
+            reply_markup=ReplyKeyboardRemove(),
+        )
+        # Skip the update
+        return
+    # If the worker is not ready...
+    if not receiving_worker.is_ready():
+        log.debug(
+            "Received a message in a chat where the worker wasn't ready yet: %s",
+            update.message.chat.id,
+        )
+        # Suggest that the user restarts the chat with /start
+        _safe_outbound(
+            log,
+            bot.send_message,
+            update.message.chat.id,
+            default_strings["error_worker_not_ready"],
+            reply_markup=ReplyKeyboardRemove(),
+        )
+        # Skip the update
+        return
+    # If the message contains the "Cancel" string defined in the strings file...
+    if update.message.text == receiving_worker.cancel_label:
+        log.debug("Forwarding CancelSignal to %s", receiving_worker)
+        # Send a CancelSignal to the worker instead of the update
+        receiving_worker.queue.put(CancelSignal())
+    else:
+        log.debug("Forwarding message to %s", receiving_worker)
+        # Forward the update to the worker
+        receiving_worker.queue.put(update)
+
+
+def _handle_callback(log, bot, chat_workers, default_strings, user_cfg, update):
+    """Handle an update containing an inline keyboard press."""
+    # Forward the update to the corresponding worker
+    receiving_worker = chat_workers.get(update.callback_query.from_user.id)
+    # Ensure a worker exists for the chat
+    if receiving_worker is None:
+        log.debug(
+            "Received a callback query in a chat without worker: %s",
+            update.callback_query.from_user.id,
+        )
+        # Suggest that the user restarts the chat with /start
+        _safe_outbound(
+            log,
+            bot.send_message,
+            update.callback_query.from_user.id,
+            default_strings["error_no_worker_for_chat"],
+        )
+        # Skip the update
+        return
+    # Check if the pressed inline key is a cancel button
+    if update.callback_query.data == "cmd_cancel":
+        log.debug("Forwarding CancelSignal to %s", receiving_worker)
+        # Forward a CancelSignal to the worker
+        receiving_worker.queue.put(CancelSignal())
+        # Notify the Telegram client that the inline keyboard press has been received
+        _safe_outbound(log, bot.answer_callback_query, update.callback_query.id)
+    else:
+        log.debug("Forwarding callback query to %s", receiving_worker)
+        # Forward the update to the worker
+        receiving_worker.queue.put(update)
+
+
+def _handle_precheckout(log, bot, chat_workers, default_strings, user_cfg, update):
+    """Handle an update containing a pre-checkout query, ensuring it hasn't expired before forwarding it."""
+    # Forward the update to the corresponding worker
+    receiving_worker = chat_workers.get(update.pre_checkout_query.from_user.id)
+    # Check if it's the active invoice for this chat
+    if (
+        receiving_worker is None
+        or update.pre_checkout_query.invoice_payload != receiving_worker.invoice_payload
+    ):
+        # Notify the user that the invoice has expired
+        log.debug(
+            "Received a pre-checkout query for an expired invoice in: %s",
+            update.pre_checkout_query.from_user.id,
+        )
+        _safe_outbound(
+            log,
+            _answer_expired_pre_checkout,
+            log,
+            bot,
+            update.pre_checkout_query.id,
+            default_strings["error_invoice_expired"],
+        )
+        # Go to the next update
+        return
+    log.debug("Forwarding pre-checkout query to %s", receiving_worker)
+    # Forward the update to the worker
+    receiving_worker.queue.put(update)
+
+
 def main():
     current_thread().name = "Core"
+    log = getLogger("core")
 
     try:
         user_cfg = load_config()
         setup_logging(user_cfg["Logging"]["level"], user_cfg["Logging"]["format"])
-        engine = setup_database(user_cfg["Database"]["engine"])
+        setup_database(user_cfg["Database"]["engine"])
         bot, me = initialize_bot(user_cfg)
     except (FileNotFoundError, ValueError) as e:
-        getLogger("core").fatal(e)
+        log.fatal(e)
         exit(1)
 
     # Finding default language
     default_language = user_cfg["Language"]["default_language"]
     # Creating localization object
     default_loc = Localization(language=default_language, fallback=default_language)
+    # Resolve the error messages sent by the main loop only once, the first time each one is needed
+    default_strings = _DefaultStrings(default_loc)
 
     # Create a dictionary linking the chat ids to the Worker objects
-    chat_workers = {}
+    # Only weak references are kept, so workers are freed as soon as their thread ends
+    chat_workers = weakref.WeakValueDictionary()
 
     # Current update offset; if None it will get the last 100 unparsed messages
     next_update = None
 
     # Notify on the console that the bot is starting
-    getLogger("core").info(f"@{me.username} is starting!")
+    log.info("@%s is starting!", me.username)
+
+    # The long polling timeout doesn't change while the bot is running
+    update_timeout = user_cfg["Telegram"]["long_polling_timeout"]
+    # Number of updates received in the previous batch
+    last_count = 0
 
     # Main loop of the program
     while True:
+        # If the previous batch was full, more updates are already waiting: drain them without long polling
+        if last_count >= UPDATES_BATCH_SIZE:
+            log.warning(
+                "Received a full batch of %s updates, draining the backlog", last_count
+            )
+            poll_timeout = 0
+        else:
+            poll_timeout = update_timeout
         # Get a new batch of 100 updates and mark the last 100 parsed as read
-        update_timeout = user_cfg["Telegram"]["long_polling_timeout"]
-        getLogger("core").debug(
-            f"Getting updates from Telegram with a timeout of {update_timeout} seconds"
+        log.debug(
+            "Getting updates from Telegram with a timeout of %s seconds", poll_timeout
+        )
+        updates = bot.get_updates(
+            offset=next_update,
+            timeout=poll_timeout,
+            allowed_updates=ALLOWED_UPDATES,
         )
-        updates = bot.get_updates(offset=next_update, timeout=update_timeout)
-        # Parse all the updates
+        # DuckBot returns None if it gave up on the call: treat it as an empty batch, and wait before polling again
+        if updates is None:
+            last_count = 0
+            sleep(user_cfg["Telegram"]["error_pause"])
+            continue
+        last_count = len(updates)
+        # Parse all the updates; each update carries exactly one of these fields
         for update in updates:
+            # Mark the update as read before handling it, so that an update that fails isn't received again
+            next_update = update.update_id + 1
             # If the update is a message...
             if update.message is not None:
-                # Ensure the message has been sent in a private chat
-                if update.message.chat.type != "private":
-                    getLogger("core").debug(
-                        f"Received a message from a non-private chat: {update.message.chat.id}"
-                    )
-                    # Notify the chat
-                    bot.send_message(
-                        update.message.chat.id, default_loc.get("error_nonprivate_chat")
-                    )
-                    # Skip the update
-                    continue
-                # If the message is a start command...
-                if isinstance(
-                    update.message.text, str
-                ) and update.message.text.startswith("/start"):
-                    getLogger("core").info(
-                        f"Received /start from: {update.message.chat.id}"
-                    )
-                    # Check if a worker already exists for that chat
-                    old_worker = chat_workers.get(update.message.chat.id)
-                    # If it exists, gracefully stop the worker
-                    if old_worker:
-                        getLogger("core").debug(
-                            f"Received request to stop {old_worker.name}"
-                        )
-                        old_worker.stop("request")
-                    # Initialize a new worker for the chat
-                    new_worker = Worker(
-                        bot=bot,
-                        chat=update.message.chat,
-                        telegram_user=update.message.from_user,
-                        cfg=user_cfg,
-                        engine=engine,
-                        daemon=True,
-                    )
-                    # Start the worker
-                    getLogger("core").debug(f"Starting {new_worker.name}")
-                    new_worker.start()
-                    # Store the worker in the dictionary
-                    chat_workers[update.message.chat.id] = new_worker
-                    # Skip the update
-                    continue
-                # Otherwise, forward the update to the corresponding worker
-                receiving_worker = chat_workers.get(update.message.chat.id)
-                # Ensure a worker exists for the chat and is alive
-                if receiving_worker is None:
-                    getLogger("core").debug(
-                        f"Received a message in a chat without worker: {update.message.chat.id}"
-                    )
-                    # Suggest that the user restarts the chat with /start
-                    bot.send_message(
-                        update.message.chat.id,
-                        default_loc.get("error_no_worker_for_chat"),
-                        reply_markup=ReplyKeyboardRemove(),
-                    )
-                    # Skip the update
-                    continue
-                # If the worker is not ready...
-                if not receiving_worker.is_ready():
-                    getLogger("core").debug(
-                        f"Received a message in a chat where the worker wasn't ready yet: {update.message.chat.id}"
-                    )
-                    # Suggest that the user restarts the chat with /start
-                    bot.send_message(
-                        update.message.chat.id,
-                        default_loc.get("error_worker_not_ready"),
-                        reply_markup=ReplyKeyboardRemove(),
-                    )
-                    # Skip the update
-                    continue
-                # If the message contains the "Cancel" string defined in the strings file...
-                if update.message.text == receiving_worker.loc.get("menu_cancel"):
-                    getLogger("core").debug(
-                        f"Forwarding CancelSignal to {receiving_worker}"
-                    )
-                    # Send a CancelSignal to the worker instead of the update
-                    receiving_worker.queue.put(CancelSignal())
-                else:
-                    getLogger("core").debug(f"Forwarding message to {receiving_worker}")
-                    # Forward the update to the worker
-                    receiving_worker.queue.put(update)
+                handler = _handle_message
             # If the update is a inline keyboard press...
-            if isinstance(update.callback_query, CallbackQuery):
-                # Forward the update to the corresponding worker
-                receiving_worker = chat_workers.get(update.callback_query.from_user.id)
-                # Ensure a worker exists for the chat
-                if receiving_worker is None:
-                    getLogger("core").debug(
-                        f"Received a callback query in a chat without worker: {update.callback_query.from_user.id}"
-                    )
-                    # Suggest that the user restarts the chat with /start
-                    bot.send_message(
-                        update.callback_query.from_user.id,
-                        default_loc.get("error_no_worker_for_chat"),
-                    )
-                    # Skip the update
-                    continue
-                # Check if the pressed inline key is a cancel button
-                if update.callback_query.data == "cmd_cancel":
-                    getLogger("core").debug(
-                        f"Forwarding CancelSignal to {receiving_worker}"
-                    )
-                    # Forward a CancelSignal to the worker
-                    receiving_worker.queue.put(CancelSignal())
-                    # Notify the Telegram client that the inline keyboard press has been received
-                    bot.answer_callback_query(update.callback_query.id)
-                else:
-                    getLogger("core").debug(
-                        f"Forwarding callback query to {receiving_worker}"
-                    )
-                    # Forward the update to the worker
-                    receiving_worker.queue.put(update)
-            # If the update is a precheckoutquery, ensure it hasn't expired before forwarding it
-            if isinstance(update.pre_checkout_query, PreCheckoutQuery):
-                # Forward the update to the corresponding worker
-                receiving_worker = chat_workers.get(
-                    update.pre_checkout_query.from_user.id
-                )
-                # Check if it's the active invoice for this chat
-                if (
-                    receiving_worker is None
-                    or update.pre_checkout_query.invoice_payload
-                    != receiving_worker.invoice_payload
-                ):
-                    # Notify the user that the invoice has expired
-                    getLogger("core").debug(
-                        f"Received a pre-checkout query for an expired invoice in: {update.pre_checkout_query.from_user.id}"
-                    )
-                    try:
-                        bot.answer_pre_checkout_query(
-                            update.pre_checkout_query.id,
-                            ok=False,
-                            error_message=default_loc.get("error_invoice_expired"),
-                        )
-                    except error.BadRequest:
-                        getLogger("core").error(
-                            "pre-checkout query expired before an answer could be sent!"
-                        )
-                    # Go to the next update
-                    continue
-                getLogger("core").debug(
-                    f"Forwarding pre-checkout query to {receiving_worker}"
-                )
-                # Forward the update to the worker
-                receiving_worker.queue.put(update)
-        # If there were any updates...
-        if len(updates):
-            # Mark them as read by increasing the update_offset
-            next_update = updates[-1].update_id + 1
+            elif update.callback_query is not None:
+                handler = _handle_callback
+            # If the update is a precheckoutquery...
+            elif update.pre_checkout_query is not None:
+                handler = _handle_precheckout
+            else:
+                continue
+            # An error while handling a single update must not stop the whole bot
+            # noinspection PyBroadException
+            try:
+                handler(log, bot, chat_workers, default_strings, user_cfg, update)
+            except Exception:
+                log.exception("Failed to handle update %s", update.update_id)
 
 
 if __name__ == "__main__":
@@ -1,9 +1,10 @@
+import functools
 import logging
 import typing
-from sqlalchemy import Column, ForeignKey
+from sqlalchemy import Column, ForeignKey, event
 from sqlalchemy import Integer, BigInteger, String, Boolean
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, scoped_session, sessionmaker
 
 if typing.TYPE_CHECKING:
     import worker
@@ -13,6 +14,10 @@ log = logging.getLogger(__name__)
 # Create a base class to define all the database subclasses
 TableDeclarativeBase = declarative_base()
 
+# Thread-local sessions shared by all the workers, bound to the engine once it is created
+# Objects stay usable after their session is closed, as they aren't expired on commit
+Session = scoped_session(sessionmaker(expire_on_commit=False))
+
 
 # Define all the database tables using the sqlalchemy declarative base
 class User(TableDeclarativeBase):
@@ -43,6 +48,10 @@ class User(TableDeclarativeBase):
 
     def __str__(self):
         """Describe the user in the best way possible given the available data."""
+        return self._str_cached
+
+    @functools.cached_property
+    def _str_cached(self):
         if self.username is not None:
             return f"@{self.username}"
         elif self.last_name is not None:
@@ -54,6 +63,7 @@ class User(TableDeclarativeBase):
         """Describe the user in the best way possible, ensuring a way back to the database record exists."""
         return f"user_{self.user_id} ({str(self)})"
 
+    @functools.cached_property
     def mention(self):
         """Mention the user in the best way possible given the available data."""
         if self.username is not None:
@@ -61,7 +71,7 @@ class User(TableDeclarativeBase):
         else:
             return f"[{self.first_name}](tg://user?id={self.user_id})"
 
-    @property
+    @functools.cached_property
     def full_name(self):
         if self.last_name:
             return f"{self.first_name} {self.last_name}"
@@ -69,6 +79,17 @@ class User(TableDeclarativeBase):
             return self.first_name
 
 
+@event.listens_for(User, "expire")
+@event.listens_for(User, "refresh")
+@event.listens_for(User.first_name, "set")
+@event.listens_for(User.last_name, "set")
+@event.listens_for(User.username, "set")
+def _clear_user_cached_strings(target, *args):
+    """Forget the cached descriptions of an user, as the data they were built from may have changed."""
+    for name in ("_str_cached", "mention", "full_name"):
+        target.__dict__.pop(name, None)
+
+
 class Admin(TableDeclarativeBase):
     """A administrator with his permissions."""
 
@@ -1,3 +1,4 @@
+import functools
 import logging
 import sys
 import time
@@ -16,6 +17,7 @@ def factory(cfg: nuconfig.NuConfig):
     def catch_telegram_errors(func):
         """Decorator, can be applied to any function to retry in case of Telegram errors."""
 
+        @functools.wraps(func)
         def result_func(*args, **kwargs):
             while True:
                 try:
@@ -24,6 +26,13 @@ def factory(cfg: nuconfig.NuConfig):
                 except telegram.error.Unauthorized:
                     log.debug(f"Unauthorized to call {func.__name__}(), skipping.")
                     break
+                # Telegram is rate limiting the bot
+                except telegram.error.RetryAfter as error:
+                    log.warning(
+                        f"Rate limited while calling {func.__name__}(),"
+                        f" retrying in {error.retry_after} secs..."
+                    )
+                    time.sleep(error.retry_after)
                 # Telegram API didn't answer in time
                 except telegram.error.TimedOut:
                     log.warning(
@@ -1,3 +1,4 @@
+import functools
 import importlib
 import json
 import logging
@@ -14,6 +15,21 @@ class IgnoreDict(dict):
         return "{" + key + "}"
 
 
+@functools.lru_cache(maxsize=4096)
+def _find_string(module: types.ModuleType, fallback_module: Optional[types.ModuleType], key: str) -> str:
+    """Find the unformatted string with the given key, caching it as the strings modules never change."""
+    try:
+        string = module.__getattribute__(key)
+    except AttributeError:
+        if fallback_module:
+            log.warning(f"Missing localized string with key {key}, using default")
+            string = fallback_module.__getattribute__(key)
+        else:
+            raise
+    assert isinstance(string, str)
+    return string
+
+
 class Localization:
     def __init__(self, language: str, *, fallback: str, replacements: Dict[str, str] = None):
         log.debug(f"Creating localization for {language}")
@@ -31,16 +47,8 @@ class Localization:
         self.replacements: Dict[str, str] = replacements if replacements else {}
 
     def get(self, key: str, **kwargs) -> str:
-        try:
-            log.debug(f"Getting localized string with key {key}")
-            string = self.module.__getattribute__(key)
-        except AttributeError:
-            if self.fallback_module:
-                log.warning(f"Missing localized string with key {key}, using default")
-                string = self.fallback_module.__getattribute__(key)
-            else:
-                raise
-        assert isinstance(string, str)
+        log.debug(f"Getting localized string with key {key}")
+        string = _find_string(self.module, self.fallback_module, key)
         formatter = IgnoreDict(**self.replacements, **kwargs)
         return string.format_map(formatter)
 
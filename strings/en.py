@@ -59,6 +59,15 @@ emoji_yes = "✅"
 # Emoji: no
 emoji_no = "🚫"
 
+# Error: a message was sent in a group or channel, but the bot only works in private chats
+error_nonprivate_chat = "⚠️ This bot only works in private chats."
+
+# Error: a payment was attempted on an invoice that is no longer active
+error_invoice_expired = (
+    "⚠️ This invoice has expired and was cancelled.\n"
+    "If you still want to pay, please request a new one."
+)
+
 # Suggest the creation of a new worker with /start
 error_no_worker_for_chat = "⚠️ Bot was updated.\n" "send the /start command to the bot."
 
@@ -1,23 +1,63 @@
+import functools
+import time
+
 import requests
+from requests.adapters import HTTPAdapter
+
+# Shared HTTP session, so that connections to the same host are kept alive and reused
+_SESSION = requests.Session()
+_SESSION.headers["User-Agent"] = "tg-music-bot"
+_SESSION.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=32))
+
+_HTML_ESCAPE_TABLE = str.maketrans({"<": "&lt;", ">": "&gt;", "&": "&amp;", '"': "&quot;"})
+
 
 def telegram_html_escape(string: str):
-    return string.replace("<", "&lt;") \
-        .replace(">", "&gt;") \
-        .replace("&", "&amp;") \
-        .replace('"', "&quot;")
+    # Most strings contain nothing to escape: return them without copying
+    if not any(char in string for char in '<>&"'):
+        return string
+    return string.translate(_HTML_ESCAPE_TABLE)
+
+
+def submit_logged(executor, log, func, *args, **kwargs):
+    """Run a call in the given executor, logging its errors instead of losing them in the discarded future."""
+
+    def call():
+        # noinspection PyBroadException
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            log.exception("Background call %s failed", func.__name__)
+
+    return executor.submit(call)
+
+
+def download(url, headers=None):
+    """Download the content of an url, reusing the connections of the shared session."""
+    response = _SESSION.get(url, headers=headers, timeout=30)
+    response.raise_for_status()
+    return response.content
 
 
 def check_thumbnail(thumbnail_url):
     try:
-        response = requests.get(thumbnail_url)
-        if response.status_code == 200:
-            content_type = response.headers.get('Content-Type', '')
-            content_length = int(response.headers.get('Content-Length', '0'))
-
-            # Check if the content type is JPEG and the file size is less than 200 kB
-            if content_type.startswith('image/jpeg') and content_length < 200 * 1024:
-                return thumbnail_url  # Valid thumbnail URL
-    except Exception as e:
-        pass
-
-    return None
\ No newline at end of file
+        # Results are cached per hour, as the image behind an url may change over time
+        return _check_thumbnail_cached(thumbnail_url, time.time() // 3600)
+    except (requests.RequestException, ValueError):
+        # Failed checks raise inside the cache, so they are retried next time
+        return None
+
+
+@functools.lru_cache(maxsize=1024)
+def _check_thumbnail_cached(thumbnail_url, _hour):
+    # Only the headers are needed, so don't download the image itself
+    response = _SESSION.head(thumbnail_url, allow_redirects=True, timeout=5)
+    if response.status_code == 200:
+        content_type = response.headers.get('Content-Type', '')
+        content_length = int(response.headers.get('Content-Length', '0'))
+
+        # Check if the content type is JPEG and the file size is less than 200 kB
+        if content_type.startswith('image/jpeg') and content_length < 200 * 1024:
+            return thumbnail_url  # Valid thumbnail URL
+
+    return None
@@ -1,15 +1,16 @@
 import datetime
+import itertools
 import logging
 import queue as queuem
 import re
 import sys
 import threading
+import time
 import traceback
-from typing import List, Optional, Union
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Container, Dict, FrozenSet, Optional, Union
 from os.path import basename
 
-import requests
-import sqlalchemy
 import telegram
 import youtube_dl
 
@@ -21,6 +22,31 @@ import utils
 # Setup logging
 log = logging.getLogger(__name__)
 
+# Regular expressions used while waiting for the user links
+_URL_RE = re.compile(r"(?P<url>https?://[^\s]+)")
+_MATCH_ANY_RE = re.compile(r"(.*)", re.DOTALL)
+
+# Menu keyboards already built, by menu, language and fallback language
+_MENU_KEYBOARDS: Dict[tuple, telegram.ReplyMarkup] = {}
+
+# Options of the youtube_dl instances, which only extract information without printing anything
+YDL_OPTS = {"extract_flat": True, "dumpjson": True, "quiet": True, "no_warnings": True}
+# YoutubeDL instances aren't thread safe, so every thread builds and reuses its own
+_youtube_dl_local = threading.local()
+
+# Threads shared by all the workers for blocking network calls, such as youtube_dl extractions
+IO_POOL = ThreadPoolExecutor(max_workers=16, thread_name_prefix="io")
+# The most extractions of a single playlist waiting in IO_POOL at once, so that big playlists don't block the others
+PLAYLIST_EXTRACTIONS_IN_FLIGHT = 8
+
+
+def _get_youtube_dl() -> youtube_dl.YoutubeDL:
+    """Get the YoutubeDL instance of the current thread, creating it the first time."""
+    ydl = getattr(_youtube_dl_local, "ydl", None)
+    if ydl is None:
+        ydl = _youtube_dl_local.ydl = youtube_dl.YoutubeDL(YDL_OPTS)
+    return ydl
+
 
 class StopSignal:
     """A data class for signaling a worker to stop."""
@@ -36,13 +62,19 @@ class CancelSignal:
 class Worker(threading.Thread):
     """A worker thread for handling a single conversation."""
 
+    # The reply keyboard with only the cancel button, shared by all the workers
+    _CANCEL_MARKUP = telegram.ReplyKeyboardMarkup(
+        [[telegram.KeyboardButton("🔙 Cancel")]],
+        resize_keyboard=True,
+        one_time_keyboard=True,
+    )
+
     def __init__(
         self,
         bot,
         chat: telegram.Chat,
         telegram_user: telegram.User,
         cfg: nuconfig.NuConfig,
-        engine,
         *args,
         **kwargs,
     ):
@@ -53,65 +85,69 @@ class Worker(threading.Thread):
             telegram_user,
             cfg,
         )
-        self.cancel_keyboard = [[telegram.KeyboardButton("🔙 Cancel")]]
-        self.ydl_opts = {"extract_flat": True, "dumpjson": True}
         self.ITEMS_PER_PAGE = 15
         self.MAX_RETRIES = 3
-        self.session = sqlalchemy.orm.sessionmaker(bind=engine)()
         self.user: Optional[db.User] = None
         self.admin: Optional[db.Admin] = None
-        self.queue = queuem.Queue()
+        self.loc: Optional[localization.Localization] = None
+        self.cancel_label: Optional[str] = None
+        self.admin_menu_items: FrozenSet[str] = frozenset()
+        # A SimpleQueue is implemented in C, so the dispatcher puts updates without going through Python locks
+        self.queue = queuem.SimpleQueue()
 
     def run(self):
         """The main conversation handling code."""
         log.debug("Starting conversation")
-        # Get the user db data from the users and admin tables
-        self.user = (
-            self.session.query(db.User)
-            .filter(db.User.user_id == self.chat.id)
-            .one_or_none()
-        )
-        self.admin = (
-            self.session.query(db.Admin)
-            .filter(db.Admin.user_id == self.chat.id)
-            .one_or_none()
-        )
-        # If the user isn't registered, create a new record and add it to the db
-        new_user = False
-        if self.user is None:
-            new_user = True
-            # Check if there are other registered users: if there aren't any, the first user will be owner of the bot
-            will_be_owner = self.session.query(db.Admin).first() is None
-            # Create the new record
-            self.user = db.User(w=self)
-            # Add the new record to the db
-            self.session.add(self.user)
-            # If the will be owner flag is set
-            if will_be_owner:
-                # Become owner
-                self.admin = db.Admin(user=self.user, is_owner=True)
-                # Add the admin to the transaction
-                self.session.add(self.admin)
-            # Commit the transaction
-            self.session.commit()
-            log.info(f"Created new user: {self.user}")
-            if will_be_owner:
-                log.warning(
-                    f"User was auto-promoted to Admin as no other admins existed: {self.user}"
-                )
+        with db.Session() as session:
+            # Get the user db data from the users and admin tables
+            self.user = (
+                session.query(db.User)
+                .filter(db.User.user_id == self.chat.id)
+                .one_or_none()
+            )
+            self.admin = (
+                session.query(db.Admin)
+                .filter(db.Admin.user_id == self.chat.id)
+                .one_or_none()
+            )
+            # If the user isn't registered, create a new record and add it to the db
+            new_user = False
+            if self.user is None:
+                new_user = True
+                # Check if there are other registered users: if there aren't any, the first user will be owner of the bot
+                will_be_owner = session.query(db.Admin).first() is None
+                # Create the new record
+                self.user = db.User(w=self)
+                # Add the new record to the db
+                session.add(self.user)
+                # If the will be owner flag is set
+                if will_be_owner:
+                    # Become owner
+                    self.admin = db.Admin(user=self.user, is_owner=True)
+                    # Add the admin to the transaction
+                    session.add(self.admin)
+                # Commit the transaction
+                session.commit()
+                log.info(f"Created new user: {self.user}")
+                if will_be_owner:
+                    log.warning(
+                        f"User was auto-promoted to Admin as no other admins existed: {self.user}"
+                    )
         # Create the localization object
         self._create_localization()
 
         # Capture exceptions that occour during the conversation
         if new_user:
-            admins = self.session.query(db.Admin).all()
-            num = self.session.query(db.User).all()
-            for admin in admins:
-                self.bot.send_message(
-                    chat_id=admin.user_id,
-                    text=self.loc.get(
-                        "new_user_in", number=len(num), new=self.user.identifiable_str()
-                    ),
+            with db.Session() as session:
+                admin_ids = session.query(db.Admin.user_id).all()
+                num = session.query(db.User).count()
+            text = self.loc.get(
+                "new_user_in", number=num, new=self.user.identifiable_str()
+            )
+            # Notify all the admins at the same time, without making the new user wait for it
+            for (admin_id,) in admin_ids:
+                utils.submit_logged(
+                    IO_POOL, log, self.bot.send_message, chat_id=admin_id, text=text
                 )
         # noinspection PyBroadException
         try:
@@ -142,11 +178,9 @@ class Worker(threading.Thread):
         return self.loc is not None
 
     def stop(self, reason: str = ""):
-        """Gracefully stop the worker process"""
-        # Send a stop message to the thread
+        """Gracefully stop the worker process, without waiting for the thread to end."""
+        # Send a stop message to the thread, which stops by itself once it reads the signal
         self.queue.put(StopSignal(reason))
-        # Wait for the thread to stop
-        self.join()
 
     # noinspection PyUnboundLocalVariable
     def __receive_next_update(self) -> telegram.Update:
@@ -165,7 +199,7 @@ class Worker(threading.Thread):
         return data
 
     def _wait_for_specific_message(
-        self, items: List[str], cancellable: bool = False
+        self, items: Container[str], cancellable: bool = False
     ) -> Union[str, CancelSignal]:
         """Continue getting updates until until one of the strings contained in the list is received as a message."""
         log.debug("Waiting for a specific message...")
@@ -194,7 +228,7 @@ class Worker(threading.Thread):
             return update.message.text, update.message.message_id
 
     def __wait_for_regex(
-        self, regex: str, cancellable: bool = False
+        self, regex: re.Pattern, cancellable: bool = False
     ) -> Union[str, CancelSignal]:
         """Continue getting updates until the regex finds a match in a message, then return the first capture group."""
         log.debug("Waiting for a regex...")
@@ -216,8 +250,11 @@ class Worker(threading.Thread):
             # Ensure the message contains text
             if update.message.text is None:
                 continue
+            # Any text matches, so there is no need to run the regex
+            if regex is _MATCH_ANY_RE:
+                return update.message.text, update.message.message_id
             # Try to match the regex with the received message
-            match = re.search(regex, update.message.text, re.DOTALL)
+            match = regex.search(update.message.text)
             # Ensure there is a match
             if match is None:
                 continue
@@ -249,17 +286,36 @@ class Worker(threading.Thread):
             return update.callback_query
 
     def __user_menu(self):
-        """Display the user menu."""
+        """Display the user menu, displaying it again every time the selected command ends."""
         log.debug("Displaying __user_menu")
         keyboard = self.__create_keyboard()
-        message_user_menu = self.__send_user_menu_message(keyboard)
 
         while True:
-            select = self.__wait_for_inlinekeyboard_callback()
-            self.__handle_menu_selection(select, message_user_menu)
+            message_user_menu = self.bot.send_message(
+                chat_id=self.chat.id,
+                text=self.loc.get("conversation_open_user_menu"),
+                reply_markup=keyboard,
+            )
+            # Wait until a command is selected and has run
+            while True:
+                select = self.__wait_for_inlinekeyboard_callback()
+                if self.__handle_menu_selection(select, message_user_menu):
+                    break
+
+    def _get_menu_keyboard(self, menu: str, build):
+        """Get a menu keyboard that only depends on the language, building it the first time it is needed."""
+        key = (menu, self.loc.language, self.loc.fallback_language)
+        keyboard = _MENU_KEYBOARDS.get(key)
+        if keyboard is None:
+            keyboard = _MENU_KEYBOARDS[key] = build()
+        return keyboard
 
     def __create_keyboard(self):
         """Create and return the user menu keyboard."""
+        return self._get_menu_keyboard("user", self.__build_keyboard)
+
+    def __build_keyboard(self):
+        """Build the user menu keyboard."""
         return telegram.InlineKeyboardMarkup(
             [
                 [
@@ -284,16 +340,8 @@ class Worker(threading.Thread):
             ]
         )
 
-    def __send_user_menu_message(self, keyboard):
-        """Send the user menu message and return the message object."""
-        return self.bot.send_message(
-            chat_id=self.chat.id,
-            text=self.loc.get("conversation_open_user_menu"),
-            reply_markup=keyboard,
-        )
-
-    def __handle_menu_selection(self, select, message_user_menu):
-        """Handle the user's menu selection."""
+    def __handle_menu_selection(self, select, message_user_menu) -> bool:
+        """Handle the user's menu selection, returning whether a command was run."""
         command_map = {
             "cmd_soundcloud": self._soundcloud,
             "cmd_spotify": self._spotify,
@@ -307,16 +355,18 @@ class Worker(threading.Thread):
                 chat_id=self.chat.id, message_id=message_user_menu["message_id"]
             )
             command()
+            return True
+        return False
 
     def _get_link(self, msg_link):
         i = 0
         while i < self.MAX_RETRIES:
-            link, msg_id = self.__wait_for_regex(r"(.*)", cancellable=True)
+            link, msg_id = self.__wait_for_regex(_MATCH_ANY_RE, cancellable=True)
             if isinstance(link, CancelSignal):
                 self._clean_up_messages(i, msg_link)
-                self.__user_menu()
+                return None, None
             try:
-                url = re.search("(?P<url>https?://[^\s]+)", link).group("url")
+                url = _URL_RE.search(link).group("url")
                 if "soundcloud" in url:
                     return url, msg_id
             except AttributeError:
@@ -324,6 +374,7 @@ class Worker(threading.Thread):
             self._handle_invalid_link(i, msg_link)
             i += 1
         self.bot.send_message(chat_id=self.chat.id, text=self.loc.get("invalid_link"))
+        return None, None
 
     def _handle_invalid_link(self, i, msg_link):
         if i >= 1:
@@ -333,9 +384,7 @@ class Worker(threading.Thread):
         self.bot.send_message(
             chat_id=self.chat.id,
             text=self.loc.get("invalid_link"),
-            reply_markup=telegram.ReplyKeyboardMarkup(
-                self.cancel_keyboard, resize_keyboard=True, one_time_keyboard=True
-            ),
+            reply_markup=Worker._CANCEL_MARKUP,
         )
 
     def _clean_up_messages(self, i, msg_link):
@@ -348,9 +397,7 @@ class Worker(threading.Thread):
         msg_link = self.bot.send_message(
             self.chat.id,
             self.loc.get("msg_link"),
-            reply_markup=telegram.ReplyKeyboardMarkup(
-                self.cancel_keyboard, resize_keyboard=True, one_time_keyboard=True
-            ),
+            reply_markup=Worker._CANCEL_MARKUP,
         )
         link, msg_id = self._get_link(msg_link)
         if link is None:
@@ -371,9 +418,12 @@ class Worker(threading.Thread):
             )
             print(f"Error: {e}")
 
+    def _extract(self, url):
+        """Extract the information about an url with youtube_dl, without downloading anything."""
+        return _get_youtube_dl().extract_info(url=url, download=False)
+
     def _handle_extraction(self, link, start_msg):
-        with youtube_dl.YoutubeDL(self.ydl_opts) as ydl:
-            data = ydl.extract_info(url=link, download=False)
+        data = self._extract(link)
         if "_type" in data:
             if data["_type"] == "playlist":
                 self._handle_playlist(data, start_msg)
@@ -393,7 +443,6 @@ class Worker(threading.Thread):
                 url=data["webpage_url"],
             ),
         )
-        tracks = []
         collect = self.bot.send_message(
             chat_id=self.chat.id,
             text=self.loc.get(
@@ -402,32 +451,61 @@ class Worker(threading.Thread):
                 all_tracks=len(data["entries"]),
             ),
         )
-        for da in data["entries"]:
+        # Extract the tracks concurrently, while this thread only reports the progress about once a second
+        entries = iter(data["entries"])
+        futures = []
+        pending = set()
+        reported = 0
+        last_report = time.monotonic()
+        while True:
+            # Keep only a few extractions in flight, so that IO_POOL is shared fairly with the other workers
+            for entry in itertools.islice(
+                entries, PLAYLIST_EXTRACTIONS_IN_FLIGHT - len(pending)
+            ):
+                future = IO_POOL.submit(self._extract, entry["url"])
+                futures.append(future)
+                pending.add(future)
+            if not pending:
+                break
+            # Refill the window as soon as a track is done
+            _, pending = wait(pending, timeout=1.0, return_when=FIRST_COMPLETED)
+            track = len(futures) - len(pending)
+            # Telegram rate limits message edits, so report at most once a second, and only if something changed
+            if (
+                track == reported
+                or track == len(data["entries"])
+                or time.monotonic() - last_report < 1.0
+            ):
+                continue
+            reported = track
+            last_report = time.monotonic()
             self.bot.edit_message_text(
                 chat_id=self.chat.id,
                 text=self.loc.get(
                     "get_information",
-                    track=data["entries"].index(da) + 1,
+                    track=track,
                     all_tracks=len(data["entries"]),
                 ),
                 message_id=collect["message_id"],
             )
-            with youtube_dl.YoutubeDL(self.ydl_opts) as ydl:
-                tracks.append(ydl.extract_info(url=da["url"], download=False))
+        # Only keep what the list needs: the full track data is extracted again when a track is selected
+        titles = [future.result()["title"] for future in futures]
+        urls = [future.result()["webpage_url"] for future in futures]
+        del futures
         self.bot.delete_message(chat_id=self.chat.id, message_id=collect["message_id"])
         self.__show_many(
-            data_list=tracks,
+            titles=titles,
+            urls=urls,
             page=0,
-            ydl_opts=self.ydl_opts,
             message_id=start_msg["message_id"],
         )
 
     def _handle_url(self, data, start_msg):
-        with youtube_dl.YoutubeDL(self.ydl_opts) as ydl:
-            data = ydl.extract_info(url=data["url"], download=False)
+        data = self._extract(data["url"])
         if data.get("_type"):
             self._handle_playlist(data, start_msg)
-        self.__show_one(data=data, message_id=start_msg["message_id"])
+        else:
+            self.__show_one(data=data, message_id=start_msg["message_id"])
 
     def _create_format_buttons(self, formats):
         """Create buttons for available formats."""
@@ -449,28 +527,40 @@ class Worker(threading.Thread):
         return format_buttons, format_urls
 
     def _get_best_thumbnail(self, thumbnails):
-        """Return the best thumbnail based on resolution."""
-        best_thumbnail = None
-        for thumbnail_info in thumbnails:
-            if "resolution" in thumbnail_info:
-                if (
-                    not best_thumbnail
-                    or thumbnail_info["width"] > best_thumbnail["width"]
-                    and utils.check_thumbnail(best_thumbnail["url"])
-                ):
-                    best_thumbnail = thumbnail_info
-        return best_thumbnail
-
-    def _create_buttons(self, page_data):
+        """Return the widest thumbnail, if it can be used as a cover."""
+        candidates = [
+            thumbnail_info
+            for thumbnail_info in thumbnails
+            if "resolution" in thumbnail_info and "width" in thumbnail_info
+        ]
+        if not candidates:
+            return None
+        best_thumbnail = max(candidates, key=lambda t: t["width"])
+        # Only the chosen thumbnail needs to be checked over the network
+        return best_thumbnail if utils.check_thumbnail(best_thumbnail["url"]) else None
+
+    def _create_buttons(self, page_titles):
         """Create buttons for each data item."""
         buttons = [
             telegram.InlineKeyboardButton(
-                text=f"{i + 1}. {data['title']}", callback_data=f"button_{i}"
+                text=f"{i + 1}. {title}", callback_data=f"button_{i}"
             )
-            for i, data in enumerate(page_data)
+            for i, title in enumerate(page_titles)
         ]
         return buttons
 
+    def _create_page_keyboard(self, titles, page):
+        """Create the keyboard of a page of the list, with the navigation buttons at the bottom."""
+        start_idx = page * self.ITEMS_PER_PAGE
+        end_idx = (page + 1) * self.ITEMS_PER_PAGE
+        buttons = self._create_buttons(titles[start_idx:end_idx])
+        keyboard = [buttons[i : i + 2] for i in range(0, len(buttons), 2)]
+
+        navigation_buttons = self._create_navigation_buttons(page, len(titles))
+        keyboard.append(navigation_buttons)
+
+        return telegram.InlineKeyboardMarkup(keyboard)
+
     def _create_navigation_buttons(self, page, data_list_length):
         """Create navigation buttons for pagination."""
         navigation_buttons = []
@@ -493,7 +583,8 @@ class Worker(threading.Thread):
         )
         return navigation_buttons
 
-    def __show_one(self, data, message_id, data_list=None):
+    def __show_one(self, data, message_id, from_list: bool = False) -> bool:
+        """Show a single track, returning True if the user asked to go back to the list it was selected from."""
         best_thumbnail = self._get_best_thumbnail(data["thumbnails"])
         thumbnail_button = (
             telegram.InlineKeyboardButton(
@@ -531,59 +622,77 @@ class Worker(threading.Thread):
 
         select = self.__wait_for_inlinekeyboard_callback(cancellable=True)
         if isinstance(select, CancelSignal):
-            if data_list is None:
-                self.bot.delete_message(chat_id=self.chat.id, message_id=message_id)
-                self.__user_menu()
-            else:
-                self.__show_many(data_list, 0, self.ydl_opts, message_id)
+            if from_list:
+                return True
+            self.bot.delete_message(chat_id=self.chat.id, message_id=message_id)
         elif select.data == "download_cover":
             self.bot.delete_message(chat_id=self.chat.id, message_id=message_id)
             self.bot.send_photo(
                 chat_id=self.chat.id,
-                photo=requests.get(url=best_thumbnail["url"], stream=True).content,
+                photo=utils.download(best_thumbnail["url"]),
                 filename=basename(select.data),
                 parse_mode="HTML",
             )
-            self.__user_menu()
-
         elif select.data.startswith("download_format:"):
-            self.__send_file(select, data, format_urls, message_id, best_thumbnail)
-
-    def __show_many(self, data_list, page, ydl_opts, message_id):
-        start_idx = page * self.ITEMS_PER_PAGE
-        end_idx = (page + 1) * self.ITEMS_PER_PAGE
-        page_data = data_list[start_idx:end_idx]
-
-        buttons = self._create_buttons(page_data)
-        keyboard = [buttons[i : i + 2] for i in range(0, len(buttons), 2)]
-
-        navigation_buttons = self._create_navigation_buttons(page, len(data_list))
-        keyboard.append(navigation_buttons)
-
-        reply_markup = telegram.InlineKeyboardMarkup(keyboard)
-        self.bot.edit_message_reply_markup(
-            chat_id=self.chat.id,
-            message_id=message_id,
-            reply_markup=reply_markup,
-        )
+            self.__send_file(
+                select,
+                data,
+                format_urls,
+                message_id,
+                best_thumbnail["url"] if best_thumbnail else None,
+            )
+        return False
+
+    def __show_many(self, titles, urls, page, message_id):
+        """Show a paginated list of tracks, until the user cancels or is done with a track."""
+        # The keyboard of a page never changes, so build each one only once
+        keyboards = {}
+        # The keyboard currently displayed in the message, which Telegram refuses to set again
+        shown_markup = None
+        while True:
+            reply_markup = keyboards.get(page)
+            if reply_markup is None:
+                reply_markup = keyboards[page] = self._create_page_keyboard(
+                    titles, page
+                )
+            if reply_markup is not shown_markup:
+                self.bot.edit_message_reply_markup(
+                    chat_id=self.chat.id,
+                    message_id=message_id,
+                    reply_markup=reply_markup,
+                )
+                shown_markup = reply_markup
 
-        select = self.__wait_for_inlinekeyboard_callback()
-        if select.data == "cmd_cancel":
-            self.bot.delete_message(chat_id=self.chat.id, message_id=message_id)
-            self.__user_menu()
-        elif select.data in ["next", "prev"]:
-            new_page = page + 1 if select.data == "next" else page - 1
-            self.__show_many(data_list, new_page, ydl_opts, message_id)
-        else:
-            selected_item_idx = int(select.data.split("_")[1])
-            selected_data_item = page_data[selected_item_idx]
-            self.__show_one(selected_data_item, message_id, data_list)
+            # The cancel button reaches the worker as a CancelSignal
+            select = self.__wait_for_inlinekeyboard_callback(cancellable=True)
+            if isinstance(select, CancelSignal) or select.data == "cmd_cancel":
+                self.bot.delete_message(chat_id=self.chat.id, message_id=message_id)
+                return
+            elif select.data in ["next", "prev"]:
+                page = page + 1 if select.data == "next" else page - 1
+            elif select.data.startswith("button_"):
+                selected_item_idx = int(select.data.split("_")[1])
+                # The formats urls expire, so get fresh data for the selected track
+                selected_data_item = self._extract(
+                    urls[page * self.ITEMS_PER_PAGE + selected_item_idx]
+                )
+                if not self.__show_one(selected_data_item, message_id, from_list=True):
+                    return
+                # Go back to the first page of the list: the message text still describes the closed track,
+                # but __show_one replaced its keyboard, so the list keyboard has to be set again
+                page = 0
+                shown_markup = None
+            # Any other button, such as one of an older menu, is ignored while waiting for the next one
 
     def _send_audio_file(self, url, headers, title, uploader, thumb_url):
         """Send the audio file to the user."""
         try:
-            audio_content = requests.get(url, stream=True, headers=headers).content
-            thumb_content = requests.get(url=thumb_url, stream=True).content
+            # Download the cover, if there is one, while the audio is downloading
+            thumb_future = (
+                IO_POOL.submit(utils.download, thumb_url) if thumb_url else None
+            )
+            audio_content = utils.download(url, headers=headers)
+            thumb_content = thumb_future.result() if thumb_future else None
             self.bot.send_audio(
                 chat_id=self.chat.id,
                 audio=audio_content,
@@ -598,26 +707,22 @@ class Worker(threading.Thread):
             # Optionally re-raise the exception if you want to handle it at a higher level
             # raise
 
-    def __send_file(self, select, data, format_urls, message_id, best_thumbnail):
+    def __send_file(self, select, data, format_urls, message_id, thumb_url):
         format_index = int(select.data[len("download_format:") :])
         if format_index < len(format_urls):
             self.bot.delete_message(chat_id=self.chat.id, message_id=message_id)
-            best_thumbnail = self._get_best_thumbnail(data["thumbnails"])
-            if best_thumbnail:
-                self._send_audio_file(
-                    url=format_urls[format_index],
-                    headers=data["http_headers"],
-                    title=data["title"],
-                    uploader=data["uploader"],
-                    thumb_url=best_thumbnail["url"],
-                )
-            self.__user_menu()
+            self._send_audio_file(
+                url=format_urls[format_index],
+                headers=data["http_headers"],
+                title=data["title"],
+                uploader=data["uploader"],
+                thumb_url=thumb_url,
+            )
 
     def _notify_updating(self, service_name: str):
         """Notify the user that a service is under updating."""
         update_message = self.loc.get("under_updating").format(service_name)
         self.bot.send_message(chat_id=self.chat.id, text=update_message)
-        self.__user_menu()
 
     def _spotify(self):
         """Handle Spotify-related requests."""
@@ -635,44 +740,45 @@ class Worker(threading.Thread):
         """Display the admin menu."""
         log.debug("Displaying _admin_menu")
         while True:
-            self._send_admin_menu()
-            selection = self._wait_for_user_selection()
+            # Send the admin menu to the user
+            self.bot.send_message(
+                self.chat.id,
+                self.loc.get("conversation_open_admin_menu"),
+                reply_markup=self._get_menu_keyboard(
+                    "admin",
+                    lambda: telegram.ReplyKeyboardMarkup(
+                        [[self.loc.get("menu_user_mode")]], one_time_keyboard=True
+                    ),
+                ),
+            )
+            # Wait for a reply from the user
+            selection = self._wait_for_specific_message(self.admin_menu_items)
+            # Switch to the user menu
             if selection[0] == self.loc.get("menu_user_mode"):
-                self._switch_to_user_menu()
-
-    def _send_admin_menu(self):
-        """Send the admin menu to the user."""
-        keyboard = [[self.loc.get("menu_user_mode")]]
-        self.bot.send_message(
-            self.chat.id,
-            self.loc.get("conversation_open_admin_menu"),
-            reply_markup=telegram.ReplyKeyboardMarkup(keyboard, one_time_keyboard=True),
-        )
-
-    def _wait_for_user_selection(self):
-        """Wait for a reply from the user and return the selection."""
-        return self._wait_for_specific_message([self.loc.get("menu_user_mode")])
-
-    def _switch_to_user_menu(self):
-        """Switch to the user menu."""
-        self.bot.send_message(
-            self.chat.id, self.loc.get("conversation_switch_to_user_mode")
-        )
-        self.__user_menu()
+                self.bot.send_message(
+                    self.chat.id, self.loc.get("conversation_switch_to_user_mode")
+                )
+                self.__user_menu()
 
     def _create_localization(self):
         """Create a localization object."""
-        self.loc = localization.Localization(
+        loc = localization.Localization(
             language=self.user.language,
             fallback=self.cfg["Language"]["fallback_language"],
             replacements={
                 "user_string": str(self.user),
-                "user_mention": self.user.mention(),
+                "user_mention": self.user.mention,
                 "user_full_name": self.user.full_name,
                 "user_first_name": self.user.first_name,
                 "today": datetime.datetime.now().strftime("%a %d %b %Y"),
             },
         )
+        # Cache the cancel label, as it is compared against every incoming message
+        self.cancel_label = loc.get("menu_cancel")
+        # Cache the admin menu options, as many messages may be checked against them
+        self.admin_menu_items = frozenset({loc.get("menu_user_mode")})
+        # Setting loc last makes the worker ready, so the dispatcher never sees it without the cached strings
+        self.loc = loc
 
     def _graceful_stop(self, stop_trigger: StopSignal):
         """Handle the graceful stop of the thread."""
@@ -693,5 +799,5 @@ class Worker(threading.Thread):
 
     def _close_resources(self):
         """Close any open resources, such as the database session, and exit."""
-        self.session.close()
+        db.Session.remove()
         sys.exit(0)